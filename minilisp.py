@@ -1,6 +1,7 @@
 import sys
 import re
-import math # 用於 fmod 以模擬 C++ 的模數行為
+from collections import deque # Token 串流，popleft() 為 O(1)
+from typing import ClassVar # 類別層級屬性的型別標註 (mypyc 編譯時需要)
 
 # ==============================================================================
 # 1. AST (Abstract Syntax Tree) Nodes & Interpreter Logic
@@ -10,144 +11,409 @@ import math # 用於 fmod 以模擬 C++ 的模數行為
 
 class Env(dict):
     """
-    環境 (Environment) 類別，用於儲存變數綁定。
+    全局環境 (Global Environment) 類別，用於儲存頂層 define 的變數綁定。
     繼承自 Python 的 dict，可以直接使用 env[name] = value。
+    函式內的區域變數則存放在 Frame 中，以索引存取；Frame 鏈的最外層即為此全局環境。
     """
-    def __init__(self, par=None):
-        self.par = par # 指向父級環境，實現靜態作用域 (Static Scope)
+    __slots__ = ()
 
     def find(self, n):
-        """在當前或父級環境中查找變數值。"""
+        """在全局環境中查找變數值。"""
         if n in self: return self[n]
-        if self.par: return self.par.find(n)
         error_runtime(f"Error: Variable {n} not defined") # 如果找不到，則報錯
 
+# 區域變數尚未定義時的佔位值
+_UNSET = object()
+
+# 副作用計數器：每次輸出 (print) 或讀取到「尚未定義、需往外層查找」的區域變數時遞增。
+# 函式呼叫期間若計數器不變，代表結果只取決於參數，可以安全地快取 (見 apply)。
+effects = 0
+
+# 快取只在參數會重複出現時划算：閉包連續這麼多次呼叫都沒有命中快取，就停用它的快取
+MEMO_MISS_LIMIT = 1000
+MEMO_SIZE = 1 << 16 # 每個閉包快取的最大筆數，超過時清空重來
+
+class Frame:
+    """
+    函式呼叫框架 (Call Frame)：以固定大小的列表儲存參數與區域變數。
+    變數在解析階段 (resolve) 已轉換為 (深度, 索引)，執行時不需要以名稱查找。
+    """
+    __slots__ = ('slots', 'parent')
+    def __init__(self, slots, parent): self.slots, self.parent = slots, parent # 變數槽位, 父級環境 (Frame 或全局 Env)
+
 class Node:
-    """所有 AST 節點的基類。"""
-    pass
+    """
+    所有 AST 節點的基類。
+    所有節點類別都宣告 __slots__：實例不帶 __dict__，較省記憶體，屬性存取也較快。
+    各節點以 __reduce__ 指定如何由建構參數重建，AST 才能被 pickle (mypyc 編譯後也一樣)。
+    """
+    __slots__ = ()
 
 class Val(Node):
     """
     數值節點 (Value Node)：代表一個常數值，如數字或布林值。
     """
+    __slots__ = ('v',)
     def __init__(self, v): self.v = v
+    def __reduce__(self): return Val, (self.v,)
     def eval(self, e): return self.v
 
 class Var(Node):
     """
-    變數節點 (Variable Node)：代表一個變數的名稱。
+    變數節點 (Variable Node)：代表一個全局變數的名稱。
+    depth 為由目前環境往外到全局環境需要經過的 Frame 數，由 resolve 填入。
     """
-    def __init__(self, n): self.n = n # 變數名稱
-    def eval(self, e): return e.find(self.n) # 從環境中查找變數值
+    __slots__ = ('n', 'depth')
+    def __init__(self, n, depth=0): self.n, self.depth = n, depth # 變數名稱, 與全局環境的距離
+    def __reduce__(self): return Var, (self.n, self.depth)
+    def eval(self, e):
+        d = self.depth
+        while d: e, d = e.parent, d - 1
+        return e.find(self.n) # 從全局環境中查找變數值
+
+class VarRef(Node):
+    """
+    區域變數節點 (Local Variable Node)：以 (深度, 索引) 直接存取 Frame 中的變數槽位。
+    若該槽位尚未被 define，則與原本依名稱查找相同，改由外層的解析結果 (outer) 求值。
+    """
+    __slots__ = ('depth', 'slot', 'n', 'outer')
+    def __init__(self, depth, slot, n, outer): self.depth, self.slot, self.n, self.outer = depth, slot, n, outer
+    def __reduce__(self): return VarRef, (self.depth, self.slot, self.n, self.outer)
+    def eval(self, e):
+        f, d = e, self.depth
+        while d: f, d = f.parent, d - 1
+        v = f.slots[self.slot]
+        if v is _UNSET:
+            # 結果取決於外層之後是否 define 此變數，不可被快取
+            global effects
+            effects += 1
+            return self.outer.eval(e)
+        return v
 
 class Def(Node):
     """
     定義節點 (Define Node)：代表一個變數定義語句 (define id exp)。
     """
+    __slots__ = ('n', 'v')
     def __init__(self, n, v): self.n, self.v = n, v # 變數名稱, 表達式
+    def __reduce__(self): return Def, (self.n, self.v)
     def eval(self, e):
         # PDF 規定 "Redefining is not allowed."
         if self.n in e: error_runtime(f"Error: Redefining {self.n} is not allowed.")
         e[self.n] = self.v.eval(e) # 在當前環境中定義變數
 
+class DefSlot(Node):
+    """
+    區域定義節點 (Local Define Node)：函式本體中的 (define id exp)，直接寫入 Frame 的槽位。
+    """
+    __slots__ = ('slot', 'v', 'n')
+    def __init__(self, slot, v, n): self.slot, self.v, self.n = slot, v, n # 槽位索引, 表達式, 變數名稱(錯誤訊息用)
+    def __reduce__(self): return DefSlot, (self.slot, self.v, self.n)
+    def eval(self, e):
+        if e.slots[self.slot] is not _UNSET: error_runtime(f"Error: Redefining {self.n} is not allowed.")
+        e.slots[self.slot] = self.v.eval(e)
+
 class If(Node):
     """
     If 節點：代表一個條件表達式 (if test then else)。
     """
+    __slots__ = ('t', 'a', 'b')
     def __init__(self, t, a, b): self.t, self.a, self.b = t, a, b # 測試條件, True分支, False分支
+    def __reduce__(self): return If, (self.t, self.a, self.b)
     def eval(self, e):
         # 求值測試條件，並確保它是布林值，然後根據結果求值對應分支
-        return self.a.eval(e) if check_bool(self.t.eval(e)) else self.b.eval(e)
+        t = self.t.eval(e)
+        if type(t) is not bool: bool_error(t)
+        return self.a.eval(e) if t else self.b.eval(e)
 
 class Fun(Node):
     """
     函式定義節點 (Function Definition Node)：代表一個匿名函式 (fun (args...) body...)。
     """
-    def __init__(self, args, body): self.args, self.body = args, body # 參數列表, 函式本體(AST列表)
-    def eval(self, e): return Closure(self.args, self.body, e) # 回傳一個閉包 (Closure)
+    __slots__ = ('args', 'body', 'slot_count', 'pure')
+    def __init__(self, args, body, slot_count=None, pure=True):
+        self.args, self.body = args, body # 參數列表, 函式本體(AST列表)
+        # Frame 大小, 本體是否不含輸出 (由 resolve 填入；重建已解析的節點時直接傳入)
+        self.slot_count, self.pure = len(args) if slot_count is None else slot_count, pure
+    def eval(self, e): return Closure(self.args, self.body, e, self.slot_count, self.pure) # 回傳一個閉包 (Closure)
+    def __reduce__(self): return Fun, (self.args, self.body, self.slot_count, self.pure)
 
 class Closure:
     """
     閉包 (Closure)：一個可呼叫的物件，包含了函式定義時的參數、本體和環境。
     這是實現 First-class Function 和 Static Scope 的關鍵。
     """
-    def __init__(self, args, body, env): self.args, self.body, self.env = args, body, env
+    __slots__ = ('args', 'body', 'env', 'slot_count', 'arity', 'pad', 'init', 'last', 'pure', 'cache', 'misses', 'calls', 'jit')
+    def __init__(self, args, body, env, slot_count, pure):
+        self.args, self.body, self.env, self.slot_count = args, body, env, slot_count
+        self.arity = len(args) # 參數數量
+        self.pad = [_UNSET] * (slot_count - self.arity) # 區域變數 (本體中的 define) 的初始槽位
+        self.init, self.last = body[:-1], body[-1] # 本體中最後一個語句之前的語句, 尾端位置的語句
+        self.pure, self.cache, self.misses = pure, {}, 0 # 是否可快取, {參數 tuple: 回傳值}, 連續未命中次數
+        self.calls, self.jit = 0, None # 以直譯方式執行的次數, 編譯後的 Python 函式 (見 jit_compile)
 
 class Call(Node):
     """
     函式呼叫節點 (Function Call Node)：代表一個函式呼叫 (func arg1 arg2...)。
+    被呼叫的是全局變數時 (例如遞迴的 fib)，第一次呼叫後就把 Closure 快取在 target：
+    全局變數不可重新定義，綁定之後永遠不變，之後的呼叫可略過查找、類型與參數數量檢查。
     """
-    def __init__(self, f, args): self.f, self.args = f, args # 被呼叫的函式(Fun或Var), 參數列表(AST列表)
+    __slots__ = ('f', 'args', 'target')
+    def __init__(self, f, args):
+        self.f, self.args = f, args # 被呼叫的函式(Fun或Var), 參數列表(AST列表)
+        self.target = None # 已檢查過的呼叫對象 (inline cache)
+    def __reduce__(self): return Call, (self.f, self.args) # target 是執行期的狀態，不保存
     def eval(self, e):
+        fn = self.target
+        if fn is None: fn = self.lookup(e)
+        return apply(fn, [arg.eval(e) for arg in self.args])
+    def bind(self, e):
+        """取得呼叫對象並求值實際參數，回傳 (閉包, 參數值列表)。"""
+        fn = self.target
+        if fn is None: fn = self.lookup(e)
+        return fn, [arg.eval(e) for arg in self.args] # 求值實際參數
+    def lookup(self, e):
+        """求值被呼叫的函式並檢查類型與參數數量；全局函式會被快取在 target。"""
         fn = self.f.eval(e) # 求值函式表達式，得到一個 Closure 物件
-        if not isinstance(fn, Closure): error_runtime(f"Type Error: Expect 'function' but got '{typeof(fn)}'.") # 類型檢查
-        
+        if not isinstance(fn, Closure): fun_error(fn) # 類型檢查
         # 函式呼叫的參數數量檢查 (Runtime Error)
-        if len(self.args) != len(fn.args): 
-            error_runtime(f"Need {len(fn.args)} arguments, but got {len(self.args)}.")
+        if len(self.args) != fn.arity: arity_error(fn, len(self.args))
+        if type(self.f) is Var: self.target = fn
+        return fn
+
+def apply(fn, vals):
+    """
+    以參數值 vals 呼叫閉包 fn (類型與參數數量已由 Call 檢查)。
+    尾端位置 (函式本體最後一個語句，或其中 if 的分支) 的呼叫不遞迴，
+    而是在同一個迴圈中繼續執行 (Tail Call Optimization)，因此尾遞迴不受 Python 遞迴深度限制。
+    被呼叫多次的閉包會被編譯為 Python 函式 (見 jit_compile)，之後改為直接呼叫。
+    """
+    # 純函式 (本體不含輸出) 且參數皆為數字時，以參數 tuple 查詢快取
+    # (布林值不可作為 key：True == 1 會與數字 1 撞在一起)
+    # 只有進入 apply 的這次呼叫使用快取；尾呼叫的延續不查詢也不記錄，迴圈的記憶體用量維持固定
+    key = None
+    if fn.pure and all(type(v) is int for v in vals):
+        key = tuple(vals)
+        cache = fn.cache
+        if key in cache:
+            fn.misses = 0
+            return cache[key]
+        fn.misses += 1
+        if fn.misses == MEMO_MISS_LIMIT: fn.pure, fn.cache = False, {} # 參數幾乎不重複，快取只是額外成本
+        elif len(cache) >= MEMO_SIZE: cache.clear()
+        mark = effects
+    while True:
+        if fn.jit is not None:
+            res = fn.jit(*vals)
+            if type(res) is tuple: # 編譯後函式的尾呼叫：回傳 (閉包, 參數值列表)，由此迴圈繼續執行
+                fn, vals = res
+                continue
+            break
+        fn.calls += 1
+        if fn.calls == JIT_THRESHOLD: fn.jit = jit_compile(fn) # 下一次呼叫起使用編譯版本
 
         # 創建新的環境用於函式執行，其父環境是閉包的捕獲環境 (Static Scope)
-        new_e = Env(fn.env)
-        # 綁定參數：將傳入的實際參數求值後綁定到新環境的形參上
-        for n, arg in zip(fn.args, self.args): new_e[n] = arg.eval(e)
+        # 參數值的列表直接作為 Frame 的槽位 (索引由 resolve 決定)，區域變數的槽位接在後面
+        if fn.pad: vals += fn.pad
+        new_e = Frame(vals, fn.env)
         
         # 執行函式本體：本體可能包含多個語句，求值所有語句並回傳最後一個結果
-        res = None
-        for stmt in fn.body: res = stmt.eval(new_e)
-        return res
+        for stmt in fn.init: stmt.eval(new_e)
+        node = fn.last
+        while type(node) is If: # 尾端位置的 if：直接選擇分支，分支仍在尾端位置
+            t = node.t.eval(new_e)
+            if type(t) is not bool: bool_error(t)
+            node = node.a if t else node.b
+        if type(node) is Call: # 尾呼叫：以被呼叫者繼續迴圈，不增加 Python 堆疊
+            fn, vals = node.bind(new_e)
+            continue
+        res = node.eval(new_e)
+        break
+
+    # 執行期間沒有發生任何副作用 (包含被呼叫的其他函式) 才寫入快取
+    if key is not None and effects == mark: cache[key] = res
+    return res
 
 class Op(Node):
     """
     運算節點 (Operation Node)：代表各種數值或邏輯運算 (+, -, and, or 等)。
+    每個運算符號都有對應的子類別 (見 OP_CLASSES)，解析時即決定，
+    參數數量也已在解析時檢查，eval 不需再比對運算符號字串。
     """
-    def __init__(self, op, args): self.op, self.args = op, args # 運算符號, 參數列表(AST列表)
+    __slots__ = ('args',)
+    op: ClassVar[str] = '' # 運算符號
+    operand: ClassVar[type] = int # 運算元應有的類型 (常數摺疊時用來確認求值不會出錯)
+    def __init__(self, args): self.args = args # 參數列表(AST列表)
+    def __reduce__(self): return type(self), (self.args,) # 各運算子類別共用
+
+class AddOp(Op):
+    __slots__ = ()
+    op = '+'
+    def eval(self, e):
+        vs = [a.eval(e) for a in self.args] # 先求值所有運算元，再依序檢查類型 (與參考實作相同)
+        r = 0
+        for v in vs:
+            if type(v) is not int: num_error(v)
+            r += v
+        return r
+
+class MulOp(Op):
+    __slots__ = ()
+    op = '*'
     def eval(self, e):
-        # --- Runtime Arity Check (執行期參數數量檢查) ---
-        cnt = len(self.args)
-        if self.op in ['+', '*', '=', 'and', 'or']:
-            if cnt < 2: error_runtime(f"Error: Need at least 2 arguments, but got {cnt}.")
-        elif self.op in ['-', '/', 'mod', '>', '<']:
-            if cnt != 2: error_runtime(f"Error: Need 2 arguments, but got {cnt}.")
-        elif self.op == 'not':
-            if cnt != 1: error_runtime(f"Error: Need 1 argument, but got {cnt}.")
-
-        # 邏輯運算 (短路求值)
-        if self.op == 'and': return all(check_bool(a.eval(e)) for a in self.args)
-        if self.op == 'or': return any(check_bool(a.eval(e)) for a in self.args)
-        
-        # 其他運算：先求值所有參數
         vs = [a.eval(e) for a in self.args]
-        
-        # 單目運算
-        if self.op == 'not': return not check_bool(vs[0])
-        
-        # 多目運算
-        if self.op == '+': return sum(check_num(x) for x in vs)
-        if self.op == '*': 
-            r=1
-            for x in vs: r*=check_num(x)
-            return r
-        
-        # 雙目運算
-        v1, v2 = vs[0], vs[1]
-        if self.op == '-': return check_num(v1) - check_num(v2)
-        if self.op == '/': 
-            if check_num(v2)==0: error_runtime("Error: Division by zero") # 除以零檢查
-            return int(check_num(v1)/v2) # 整數除法
-        if self.op == 'mod': 
-            # 使用 math.fmod 並轉 int 以模擬 C++ 的模數行為 (符號與被除數一致)
-            return int(math.fmod(check_num(v1), check_num(v2)))
-        if self.op == '>': return check_num(v1) > check_num(v2)
-        if self.op == '<': return check_num(v1) < check_num(v2)
-        if self.op == '=': return all(check_num(x)==check_num(vs[0]) for x in vs) # 等於檢查 (多參數)
+        r = 1
+        for v in vs:
+            if type(v) is not int: num_error(v)
+            r *= v
+        return r
+
+class Add2Op(AddOp):
+    """恰好兩個運算元的 + (最常見的情況)：展開迴圈，比逐一累加快。"""
+    __slots__ = ()
+    def eval(self, e):
+        x, y = self.args
+        v1, v2 = x.eval(e), y.eval(e)
+        if type(v1) is not int: num_error(v1)
+        if type(v2) is not int: num_error(v2)
+        return v1 + v2
+
+class Mul2Op(MulOp):
+    """恰好兩個運算元的 *。"""
+    __slots__ = ()
+    def eval(self, e):
+        x, y = self.args
+        v1, v2 = x.eval(e), y.eval(e)
+        if type(v1) is not int: num_error(v1)
+        if type(v2) is not int: num_error(v2)
+        return v1 * v2
+
+class EqOp(Op):
+    __slots__ = ()
+    op = '='
+    def eval(self, e):
+        # 等於檢查 (多參數)：先求值所有運算元 (其中的輸出與錯誤都會發生)，
+        # 再依序檢查類型並比較，遇到不相等即回傳
+        vs = [a.eval(e) for a in self.args]
+        v0 = vs[0]
+        if type(v0) is not int: num_error(v0)
+        for i in range(1, len(vs)):
+            v = vs[i]
+            if type(v) is not int: num_error(v)
+            if v != v0: return False
+        return True
+
+class AndOp(Op):
+    __slots__ = ()
+    op = 'and'
+    operand = bool
+    def eval(self, e):
+        for a in self.args: # 短路求值
+            v = a.eval(e)
+            if type(v) is not bool: bool_error(v)
+            if not v: return False
+        return True
+
+class OrOp(Op):
+    __slots__ = ()
+    op = 'or'
+    operand = bool
+    def eval(self, e):
+        for a in self.args: # 短路求值
+            v = a.eval(e)
+            if type(v) is not bool: bool_error(v)
+            if v: return True
+        return False
+
+class NotOp(Op):
+    __slots__ = ()
+    op = 'not'
+    operand = bool
+    def eval(self, e):
+        v = self.args[0].eval(e)
+        if type(v) is not bool: bool_error(v)
+        return not v
+
+class SubOp(Op):
+    __slots__ = ()
+    op = '-'
+    def eval(self, e):
+        x, y = self.args
+        v1, v2 = x.eval(e), y.eval(e)
+        if type(v1) is not int: num_error(v1)
+        if type(v2) is not int: num_error(v2)
+        return v1 - v2
+
+class DivOp(Op):
+    __slots__ = ()
+    op = '/'
+    def eval(self, e):
+        x, y = self.args
+        v1, v2 = x.eval(e), y.eval(e)
+        if type(v2) is not int: num_error(v2)
+        if v2==0: error_runtime("Error: Division by zero") # 除以零檢查
+        if type(v1) is not int: num_error(v1)
+        return int(v1/v2) # 整數除法
+
+class ModOp(Op):
+    __slots__ = ()
+    op = 'mod'
+    def eval(self, e):
+        x, y = self.args
+        v1, v2 = x.eval(e), y.eval(e)
+        if type(v1) is not int: num_error(v1)
+        if type(v2) is not int: num_error(v2)
+        if v2==0: error_runtime("Error: Division by zero") # 除以零檢查
+        # 模擬 C++ 的模數行為 (符號與被除數一致)，全程使用整數運算，大數也不會失去精度
+        r = abs(v1) % abs(v2)
+        return -r if v1 < 0 else r
+
+class GtOp(Op):
+    __slots__ = ()
+    op = '>'
+    def eval(self, e):
+        x, y = self.args
+        v1, v2 = x.eval(e), y.eval(e)
+        if type(v1) is not int: num_error(v1)
+        if type(v2) is not int: num_error(v2)
+        return v1 > v2
+
+class LtOp(Op):
+    __slots__ = ()
+    op = '<'
+    def eval(self, e):
+        x, y = self.args
+        v1, v2 = x.eval(e), y.eval(e)
+        if type(v1) is not int: num_error(v1)
+        if type(v2) is not int: num_error(v2)
+        return v1 < v2
+
+class ArityError(Node):
+    """
+    參數數量錯誤節點：運算的參數數量在解析時就已確定不符，
+    但依規格這屬於執行期錯誤，因此在求值到此節點時才報錯。
+    """
+    __slots__ = ('msg',)
+    def __init__(self, msg): self.msg = msg # 錯誤訊息
+    def __reduce__(self): return ArityError, (self.msg,)
+    def eval(self, e): error_runtime(self.msg)
+
+# 運算符號 -> 運算節點類別
+OP_CLASSES = {c.op: c for c in (AddOp, MulOp, EqOp, AndOp, OrOp, NotOp, SubOp, DivOp, ModOp, GtOp, LtOp)}
+# 恰好兩個運算元時改用的特化類別
+OP_BINARY = {c.op: c for c in (Add2Op, Mul2Op)}
 
 class Print(Node):
     """
     Print 節點：代表輸出語句 (print-num exp 或 print-bool exp)。
     """
+    __slots__ = ('is_n', 'exp')
     def __init__(self, is_n, exp): self.is_n, self.exp = is_n, exp # 是否為 print-num, 要輸出的表達式
+    def __reduce__(self): return Print, (self.is_n, self.exp)
     def eval(self, e):
+        global effects
         v = self.exp.eval(e)
+        effects += 1
         # 根據 is_n 判斷並輸出
         print(check_num(v) if self.is_n else ("#t" if check_bool(v) else "#f"))
 
@@ -161,14 +427,24 @@ def error_syntax(unexpected_token=None):
 
 def error_runtime(m): print(m); sys.exit(0) # 執行期錯誤的統一出口 (含 Type Error)
 
+# 運算節點的 eval 直接內嵌 `type(v) is not int` 檢查，只有出錯時才呼叫下列函式，
+# 避免每個運算元都多一次函式呼叫
+def num_error(v): error_runtime(f"Type Error: Expect 'number' but got '{typeof(v)}'.")
+
+def bool_error(v): error_runtime(f"Type Error: Expect 'boolean' but got '{typeof(v)}'.")
+
+def fun_error(v): error_runtime(f"Type Error: Expect 'function' but got '{typeof(v)}'.")
+
+def arity_error(fn, cnt): error_runtime(f"Need {fn.arity} arguments, but got {cnt}.")
+
 def check_num(v): 
     """檢查值是否為數字，否則報類型錯誤。"""
-    if type(v) is not int: error_runtime(f"Type Error: Expect 'number' but got '{typeof(v)}'.")
+    if type(v) is not int: num_error(v)
     return v
 
 def check_bool(v): 
     """檢查值是否為布林，否則報類型錯誤。"""
-    if type(v) is not bool: error_runtime(f"Type Error: Expect 'boolean' but got '{typeof(v)}'.")
+    if type(v) is not bool: bool_error(v)
     return v
 
 def typeof(v): 
@@ -180,48 +456,65 @@ def typeof(v):
 #    這部分負責將原始碼字串轉換成可執行語法樹 (AST)。
 # ==============================================================================
 
+# Token 種類 (Token Kind)：詞法分析時就完成分類，讀取器只需比較小整數
+LP, RP, TRUE, FALSE, NUM, SYM = range(6)
+# 值固定的 Token 直接共用同一個 tuple
+_FIXED_TOKENS = {LP: (LP, None), RP: (RP, None), TRUE: (TRUE, True), FALSE: (FALSE, False)}
+
+# 預先編譯的正則表達式 (模組載入時只編譯一次，避免每次呼叫都經過 re 的快取查找)
+# 每個分組依序對應一種 Token 種類，m.lastindex - 1 即為種類代碼：
+# 左括號, 右括號, #t, #f, 數字, 識別符號(含關鍵字和部分運算符)/其他運算符
+# 數字必須排在單獨的 '-' 之前，'-5' 才會被視為負數而非減號
+_TOKEN_RE = re.compile(r'(\()|(\))|(#t)|(#f)|(0|-?[1-9]\d*)|([a-z][a-z0-9\-]*|[\+\*/<>=]|-)')
+
 def tokenize(s):
     """
-    詞法分析器 (Lexer)：將原始碼字串分割成 Token 列表。
-    使用正則表達式高效匹配各種語言元素。
+    詞法分析器 (Lexer)：將原始碼字串分割成 (種類, 值) 形式的 Token 列表。
+    使用正則表達式高效匹配各種語言元素，並在此一次完成分類與數值轉換。
     """
-    # 正則表達式匹配：左括號, 右括號, #t, #f, 數字, 識別符號(含關鍵字和部分運算符), 其他運算符
-    return re.findall(r'\(|\)|#t|#f|0|-?[1-9]\d*|[a-z][a-z0-9\-]*|[\+\*/<>=]|mod|and|or|not|-', s)
+    tokens = []
+    for m in _TOKEN_RE.finditer(s):
+        kind = m.lastindex - 1
+        if kind == NUM: tokens.append((NUM, int(m.group())))   # 數字轉換
+        elif kind == SYM: tokens.append((SYM, sys.intern(m.group()))) # 識別符號 (ID, 關鍵字, 運算符等)，同名者共用同一字串物件
+        else: tokens.append(_FIXED_TOKENS[kind])               # 括號與布林值
+    return tokens
 
 def read_sexp(tokens):
     """
-    S-Expression 讀取器：將 Token 列表轉換為巢狀的 Python 列表/原子 (S-Expression)。
+    S-Expression 讀取器：將 Token 串流 (deque) 轉換為巢狀的 Python 列表/原子 (S-Expression)。
     這是 LISP 語言的核心結構。
+    以明確的堆疊 (stack) 保存尚未讀完的列表，不使用遞迴，巢狀再深也不會超過遞迴深度限制。
     """
-    if not tokens: error_syntax() # Token 列表為空，語法錯誤
-    t = tokens.pop(0) # 取出第一個 Token
-    if t == '(':
-        # 如果是左括號，開始讀取列表內容
-        L = []
-        while tokens and tokens[0] != ')': # 確保 tokens 不為空，避免 IndexError
-            L.append(read_sexp(tokens)) # 遞迴讀取子表達式
-        if not tokens: error_syntax() # 缺少右括號
-        tokens.pop(0) # 讀到右括號，彈出
-        return L
-    elif t == ')':
-        # 意外的右括號，語法錯誤
-        error_syntax(t)
-    else:
-        # 原子 (Atom)：布林值、數字、或識別符號
-        if t == '#t': return True
-        if t == '#f': return False
-        if re.match(r'0|-?[1-9]\d*$', t): return int(t) # 數字轉換
-        return t # 識別符號 (ID, 關鍵字, 運算符等)
+    stack = [] # 由外而內尚未遇到右括號的列表
+    while tokens:
+        kind, val = tokens.popleft() # 取出下一個 Token
+        if kind == LP:
+            # 左括號：開始一個新的列表
+            stack.append([])
+        elif kind == RP:
+            # 意外的右括號 (沒有對應的左括號)，語法錯誤
+            if not stack: error_syntax(')')
+            L = stack.pop() # 讀到右括號，列表完成
+            if not stack: return L
+            stack[-1].append(L) # 加入外層列表
+        elif not stack:
+            # 頂層的原子 (Atom)：布林值、數字、或識別符號，值已在詞法分析時轉換完成
+            return val
+        else:
+            stack[-1].append(val)
+    error_syntax() # Token 用完但列表未結束 (缺少右括號)
 
 def parse_prog(tokens):
     """
     程式解析器：解析整個 Mini-LISP 程式的 Token 列表，構建 AST 節點列表。
     """
+    tokens = deque(tokens) # 以 deque 取代 list.pop(0)，避免每次取 Token 都搬移整個列表
     nodes = []
     while tokens:
         sexp = read_sexp(tokens) # 讀取一個 S-Expression
         nodes.append(parse_stmt(sexp)) # 將 S-Expression 轉換為 AST 節點
-    return nodes
+    return [resolve(fold(n), []) for n in nodes] # 常數摺疊後解析變數位置
 
 def parse_stmt(s):
     """
@@ -250,7 +543,7 @@ def parse_exp(s):
     if not isinstance(s, list): # 如果是原子 (非列表)
         if type(s) in (int, bool): return Val(s) # 數字或布林值直接包裝
         # 如果是字符串原子，檢查是否為運算符關鍵字，避免將其解析為變數
-        if s in ['+', '-', '*', '/', 'mod', '>', '<', '=', 'and', 'or', 'not']: error_syntax(s)
+        if s in OP_CLASSES: error_syntax(s)
         return Var(s) # 否則視為變數
 
     # 如果是列表 (S-Expression)
@@ -273,33 +566,339 @@ def parse_exp(s):
     ops_2 = ['-','/','mod','>','<'] # 雙目運算符
     ops_n = ['+','*','=','and','or'] # 多目運算符 (>=2個參數)
     
-    if head in ops_1 + ops_2 + ops_n:
-        # 如果頭部是運算符，則解析後續參數，但不檢查數量 (移至 Runtime)
+    if isinstance(head, str) and head in OP_CLASSES:
+        # 如果頭部是運算符，則解析後續參數，並在此一次完成參數數量檢查
         args = [parse_exp(x) for x in s[1:]]
-        # 移除 Arity Check，直接生成 Op 節點
-        return Op(head, args)
+        cnt = len(args)
+        # 參數數量不符屬於執行期錯誤，產生 ArityError 節點，求值到時才報錯
+        if head in ops_n and cnt < 2: return ArityError(f"Error: Need at least 2 arguments, but got {cnt}.")
+        if head in ops_2 and cnt != 2: return ArityError(f"Error: Need 2 arguments, but got {cnt}.")
+        if head in ops_1 and cnt != 1: return ArityError(f"Error: Need 1 argument, but got {cnt}.")
+        if cnt == 2 and head in OP_BINARY: return OP_BINARY[head](args)
+        return OP_CLASSES[head](args)
     
     # 如果不是上述關鍵字或運算符，則視為函式呼叫
     # 第一個元素是函式本身 (可能是一個 Var 或一個 Fun 表達式)，後續是參數
     return Call(parse_exp(head), [parse_exp(x) for x in s[1:]])
 
 # ==============================================================================
-# 3. Main Execution
+# 3. Resolution (變數解析與靜態分析)
+#    在執行前走訪 AST：摺疊常數運算，將函式內的變數存取轉換為 (深度, 索引)，
+#    執行時只需沿 Frame 往外走固定層數並以索引取值；同時標記不含輸出的純函式。
 # ==============================================================================
-if __name__ == '__main__':
-    if len(sys.argv) < 2: sys.exit(1) # 檢查命令行參數 (需要一個檔案路徑)
-    
-    # 1. Parsing Phase (Syntax Check)
+
+def resolve(node, scopes):
+    """
+    變數解析器：scopes 為由外而內的函式作用域列表，每個作用域是 {變數名稱: 槽位索引}。
+    回傳解析後的節點 (Var/Def/Fun 等節點會被替換或更新)。
+    """
+    if isinstance(node, Var): return resolve_name(node.n, scopes, 0)
+    if isinstance(node, Def):
+        v = resolve(node.v, scopes)
+        if not scopes: return Def(node.n, v) # 頂層定義：存入全局環境
+        return DefSlot(scopes[-1][node.n], v, node.n)
+    if isinstance(node, Fun):
+        # 參數依序佔用前幾個槽位，本體中的 define 接續在後
+        scope = {p: i for i, p in enumerate(node.args)}
+        node.slot_count = len(node.args)
+        for stmt in node.body:
+            if isinstance(stmt, Def) and stmt.n not in scope:
+                scope[stmt.n] = node.slot_count
+                node.slot_count += 1
+        node.body = [resolve(stmt, scopes + [scope]) for stmt in node.body]
+        node.pure = not any(has_print(stmt) for stmt in node.body)
+        return node
+    if isinstance(node, If):
+        node.t, node.a, node.b = resolve(node.t, scopes), resolve(node.a, scopes), resolve(node.b, scopes)
+    elif isinstance(node, Call):
+        node.f = resolve(node.f, scopes)
+        node.args = [resolve(a, scopes) for a in node.args]
+    elif isinstance(node, Op):
+        node.args = [resolve(a, scopes) for a in node.args]
+    elif isinstance(node, Print):
+        node.exp = resolve(node.exp, scopes)
+    return node
+
+def fold(node):
+    """
+    常數摺疊 (Constant Folding)：由下而上將運算元皆為常數的運算直接算出結果，
+    並將條件為常數的 if 替換為被選中的分支。
+    會產生執行期錯誤的運算 (類型不符、除以零) 不摺疊，留到執行時報錯。
+    """
+    if isinstance(node, Op):
+        node.args = [fold(a) for a in node.args]
+        if all(type(a) is Val and type(a.v) is node.operand for a in node.args):
+            if isinstance(node, (DivOp, ModOp)) and node.args[1].v == 0: return node
+            return Val(node.eval(None)) # 運算元皆為 Val，求值不需要環境
+        return node
+    if isinstance(node, If):
+        node.t, node.a, node.b = fold(node.t), fold(node.a), fold(node.b)
+        if type(node.t) is Val and type(node.t.v) is bool: return node.a if node.t.v else node.b
+        return node
+    if isinstance(node, Def): node.v = fold(node.v)
+    elif isinstance(node, Fun): node.body = [fold(stmt) for stmt in node.body]
+    elif isinstance(node, Call):
+        node.f = fold(node.f)
+        node.args = [fold(a) for a in node.args]
+    elif isinstance(node, Print): node.exp = fold(node.exp)
+    return node
+
+def has_print(node):
+    """檢查節點 (含所有子節點與巢狀函式) 中是否有輸出語句。"""
+    if isinstance(node, Print): return True
+    if isinstance(node, (Def, DefSlot)): return has_print(node.v)
+    if isinstance(node, Fun): return any(has_print(stmt) for stmt in node.body)
+    if isinstance(node, If): return has_print(node.t) or has_print(node.a) or has_print(node.b)
+    if isinstance(node, Call): return has_print(node.f) or any(has_print(a) for a in node.args)
+    if isinstance(node, Op): return any(has_print(a) for a in node.args)
+    return False
+
+def resolve_name(n, scopes, depth):
+    """由內往外 (跳過 depth 層) 查找變數 n 所在的作用域；都找不到則視為全局變數。"""
+    if depth == len(scopes): return Var(n, depth)
+    scope = scopes[-1 - depth]
+    if n in scope: return VarRef(depth, scope[n], n, resolve_name(n, scopes, depth + 1))
+    return resolve_name(n, scopes, depth + 1)
+
+# ==============================================================================
+# 4. JIT (熱點函式編譯)
+#    以直譯方式被呼叫達 JIT_THRESHOLD 次的閉包，會將本體轉換為 Python 原始碼，
+#    以 compile() + exec() 產生一般的 Python 函式，之後的呼叫不再逐一走訪 AST。
+#    產生的程式碼保留與直譯時相同的求值順序、類型檢查與錯誤訊息。
+# ==============================================================================
+
+JIT_THRESHOLD = 50 # 閉包以直譯方式執行達此次數時嘗試編譯
+JIT_LITERAL_MAX = 1 << 64 # 絕對值小於此值的整數常數直接寫在產生的程式碼中
+
+# 可直接對應到 Python 運算子的雙目運算 (兩個運算元都先求值，再依序檢查類型)
+JIT_BINARY = {Add2Op: '+', Mul2Op: '*', SubOp: '-', GtOp: '>', LtOp: '<'}
+
+class Unsupported(Exception):
+    """本體含有無法編譯的節點 (多個語句、define、print、巢狀 fun 等)，維持直譯執行。"""
+
+class Codegen:
+    """
+    將單一閉包的本體轉換為 Python 原始碼。
+    參數對應到 Python 的區域變數 p0, p1...；其餘需要的物件 (AST 節點、全局環境等)
+    以 k0, k1... 的名稱放入產生函式的全域命名空間。
+    每個子表達式的結果都先存到暫存變數 (t1, t2...)，以維持原本的求值順序。
+    """
+    def __init__(self, fn):
+        self.fn = fn
+        self.lines = [] # 產生的程式碼 (函式本體)
+        self.consts = {} # 名稱 -> 物件
+        self.ntemp = 0 # 已使用的暫存變數數量
+        self.scope = Frame([], fn.env) # 代表「呼叫時的 Frame」，外層變數與全局變數可沿用原本的 eval 查找
+
+    def const(self, obj):
+        name = f"k{len(self.consts)}"
+        self.consts[name] = obj
+        return name
+
+    def temp(self):
+        self.ntemp += 1
+        return f"t{self.ntemp}"
+
+    def emit(self, ind, line): self.lines.append('    ' * ind + line)
+
+    def check(self, x, xt, want, ind):
+        """x 的靜態類型 xt 不能確定為 want 時，產生執行期類型檢查。"""
+        if xt is want: return
+        self.emit(ind, f"if type({x}) is not {want.__name__}: {'num_error' if want is int else 'bool_error'}({x})")
+
+    def compile(self):
+        """回傳編譯後的 Python 函式；無法編譯時拋出 Unsupported。"""
+        if len(self.fn.body) != 1: raise Unsupported
+        self.tail(self.fn.body[0], 1)
+        params = ', '.join(f"p{i}" for i in range(self.fn.arity))
+        src = f"def jit({params}):\n" + '\n'.join(self.lines) + '\n'
+        namespace = {
+            'apply': apply, 'Closure': Closure, '_UNSET': _UNSET, 'E': self.scope,
+            'num_error': num_error, 'bool_error': bool_error, 'fun_error': fun_error,
+            'arity_error': arity_error, 'error_runtime': error_runtime,
+        }
+        namespace.update(self.consts)
+        exec(compile(src, '<minilisp-jit>', 'exec'), namespace)
+        return namespace['jit']
+
+    def tail(self, node, ind):
+        """尾端位置：直接 return；尾呼叫則回傳 (閉包, 參數值列表)，交給 apply 的迴圈執行。"""
+        if type(node) is If:
+            c, ct = self.expr(node.t, ind)
+            self.check(c, ct, bool, ind)
+            self.emit(ind, f"if {c}:")
+            self.tail(node.a, ind + 1)
+            self.emit(ind, "else:")
+            self.tail(node.b, ind + 1)
+        elif type(node) is Call:
+            f, args = self.call(node, ind)
+            self.emit(ind, f"return ({f}, [{args}])")
+        else:
+            r, _ = self.expr(node, ind)
+            self.emit(ind, f"return {r}")
+
+    def call(self, node, ind):
+        """與 Call.bind 相同順序：求值函式、檢查類型與參數數量、再求值參數。回傳 (函式, 參數列表) 的程式碼。"""
+        if node.target is not None: # 已快取的全局函式：直接作為常數，不需查找與檢查
+            f = self.const(node.target)
+        else:
+            f, _ = self.expr(node.f, ind)
+            cnt = len(node.args)
+            self.emit(ind, f"if not isinstance({f}, Closure): fun_error({f})")
+            self.emit(ind, f"if {f}.arity != {cnt}: arity_error({f}, {cnt})")
+        return f, ', '.join(self.expr(a, ind)[0] for a in node.args)
+
+    def expr(self, node, ind):
+        """產生求值 node 的程式碼，回傳 (結果的程式碼, 靜態類型 int/bool/None)。"""
+        t = type(node)
+        if t is Val:
+            v = node.v
+            # 大整數以常數傳入，不轉成原始碼文字 (常數摺疊可能產生超過 4300 位數的整數，repr 會失敗)
+            if type(v) is int and not -JIT_LITERAL_MAX < v < JIT_LITERAL_MAX: return self.const(v), int
+            return repr(v), type(v)
+        if t is VarRef and node.depth == 0:
+            if node.slot >= self.fn.arity: raise Unsupported # 本體中 define 的區域變數
+            return f"p{node.slot}", None # 參數一定已綁定
+        if t is VarRef: # 外層函式的變數：沿用原本的查找 (含尚未定義時往外層查找)
+            r = self.temp()
+            self.emit(ind, f"{r} = {self.const(node)}.eval(E)")
+            return r, None
+        if t is Var: # 全局變數：直接查詢全局環境，找不到時由 Var.eval 報錯
+            g = self.scope
+            for _ in range(node.depth): g = g.parent
+            r = self.temp()
+            self.emit(ind, f"{r} = {self.const(g)}.get({node.n!r}, _UNSET)")
+            self.emit(ind, f"if {r} is _UNSET: {self.const(node)}.eval(E)")
+            return r, None
+        if t is If:
+            r = self.temp()
+            c, ct = self.expr(node.t, ind)
+            self.check(c, ct, bool, ind)
+            self.emit(ind, f"if {c}:")
+            a, at = self.expr(node.a, ind + 1)
+            self.emit(ind + 1, f"{r} = {a}")
+            self.emit(ind, "else:")
+            b, bt = self.expr(node.b, ind + 1)
+            self.emit(ind + 1, f"{r} = {b}")
+            return r, (at if at is bt else None)
+        if t is Call:
+            f, args = self.call(node, ind)
+            r = self.temp()
+            self.emit(ind, f"{r} = apply({f}, [{args}])")
+            return r, None
+        if isinstance(node, Op): return self.op(node, ind)
+        raise Unsupported
+
+    def op(self, node, ind):
+        """運算節點：與各 Op 子類別的 eval 相同順序求值與檢查。"""
+        t, r = type(node), self.temp()
+        if t in JIT_BINARY:
+            x, xt = self.expr(node.args[0], ind)
+            y, yt = self.expr(node.args[1], ind)
+            self.check(x, xt, int, ind)
+            self.check(y, yt, int, ind)
+            self.emit(ind, f"{r} = {x} {JIT_BINARY[t]} {y}")
+            return r, (bool if t is GtOp or t is LtOp else int)
+        if t is AddOp or t is MulOp: # 多個運算元：先全部求值，再依序檢查
+            vs = [self.expr(a, ind) for a in node.args]
+            for v, vt in vs: self.check(v, vt, int, ind)
+            self.emit(ind, f"{r} = {(' + ' if t is AddOp else ' * ').join(v for v, _ in vs)}")
+            return r, int
+        if t is DivOp:
+            x, xt = self.expr(node.args[0], ind)
+            y, yt = self.expr(node.args[1], ind)
+            self.check(y, yt, int, ind)
+            self.emit(ind, f"if {y} == 0: error_runtime('Error: Division by zero')")
+            self.check(x, xt, int, ind)
+            self.emit(ind, f"{r} = int({x} / {y})")
+            return r, int
+        if t is ModOp:
+            x, xt = self.expr(node.args[0], ind)
+            y, yt = self.expr(node.args[1], ind)
+            self.check(x, xt, int, ind)
+            self.check(y, yt, int, ind)
+            self.emit(ind, f"if {y} == 0: error_runtime('Error: Division by zero')")
+            self.emit(ind, f"{r} = abs({x}) % abs({y})")
+            self.emit(ind, f"if {x} < 0: {r} = -{r}")
+            return r, int
+        if t is NotOp:
+            x, xt = self.expr(node.args[0], ind)
+            self.check(x, xt, bool, ind)
+            self.emit(ind, f"{r} = not {x}")
+            return r, bool
+        if t is EqOp:
+            # 先全部求值；之後的類型檢查遇到不相等即停止，放在下一層縮排
+            vs = [self.expr(a, ind) for a in node.args]
+            self.emit(ind, f"{r} = False")
+            v0, vt = vs[0]
+            self.check(v0, vt, int, ind)
+            for v, vt in vs[1:]:
+                self.check(v, vt, int, ind)
+                self.emit(ind, f"if {v} == {v0}:")
+                ind += 1
+            self.emit(ind, f"{r} = True")
+            return r, bool
+        if t is AndOp or t is OrOp:
+            # 短路求值：以巢狀 if 表示「繼續求值下一個運算元」
+            self.emit(ind, f"{r} = {t is OrOp}")
+            for a in node.args:
+                v, vt = self.expr(a, ind)
+                self.check(v, vt, bool, ind)
+                self.emit(ind, f"if {v}:" if t is AndOp else f"if not {v}:")
+                ind += 1
+            self.emit(ind, f"{r} = {t is AndOp}")
+            return r, bool
+        raise Unsupported
+
+def jit_compile(fn):
+    """嘗試將閉包 fn 編譯為 Python 函式；無法編譯時回傳 None，維持直譯執行。"""
+    try:
+        return Codegen(fn).compile()
+    except (Unsupported, SyntaxError, RecursionError, MemoryError, ValueError): # 巢狀過深的程式碼 compile() 也可能失敗
+        return None
+
+# ==============================================================================
+# 5. Main Execution
+# ==============================================================================
+def parse_source(src):
+    """
+    將原始碼詞法分析並解析為 AST 節點列表。
+    任何解析階段的異常都視為語法錯誤，輸出訊息並以 sys.exit(0) 結束。
+    """
     try:
-        with open(sys.argv[1]) as f:
-            tokens = tokenize(f.read()) # 讀取檔案內容並詞法分析
-            nodes = parse_prog(tokens) # 解析 Token 列表，構建 AST
+        tokens = tokenize(src) # 詞法分析
+        return parse_prog(tokens) # 解析 Token 列表，構建 AST
     except Exception as e: # 捕獲任何解析階段的異常作為語法錯誤
         error_syntax() # 不指定錯誤 Token
 
-    # 2. Evaluation Phase (Runtime Check)
+def run_nodes(nodes):
+    """
+    以新的全局環境依序執行解析好的 AST 節點。
+    執行時會在節點上留下狀態 (Call.target 快取的全局函式屬於這次執行的全局環境)，
+    因此同一組節點只能執行一次；要再執行請重新解析 (或由 pickle 載入新的一份)。
+    """
     env = Env() # 創建一個全局環境
     for n in nodes: 
         # 執行階段不應捕獲異常並轉為 syntax error
         # 這裡發生的異常 (如 SystemExit) 會直接終止程式，或由 Python Runtime 處理
-        n.eval(env) 
+        n.eval(env)
+
+def run_file(path):
+    """
+    執行一個 Mini-LISP 程式檔案。每次執行都使用新的全局環境。
+    錯誤 (語法或執行期) 會輸出訊息並以 sys.exit(0) 結束。
+    """
+    # 1. Parsing Phase (Syntax Check)
+    try:
+        with open(path) as f:
+            src = f.read() # 讀取檔案內容
+    except Exception as e: # 無法讀取檔案同樣視為語法錯誤
+        error_syntax()
+    nodes = parse_source(src)
+
+    # 2. Evaluation Phase (Runtime Check)
+    run_nodes(nodes)
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2: sys.exit(1) # 檢查命令行參數 (需要一個檔案路徑)
+    run_file(sys.argv[1])
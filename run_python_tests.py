@@ -1,44 +1,279 @@
+import hashlib
+import io
 import os
-import subprocess
+import pickle
 import sys
+import traceback
+import tracemalloc
+from contextlib import redirect_stdout
+from multiprocessing import Pool
 
-def run_tests():
-    test_dir = "public_test_data"
-    minilisp_path = "minilisp.py"
+import minilisp
 
-    print("Starting Mini-LISP Python Test Suite...\n")
+TEST_DIR = "public_test_data"
 
-    # 確保 minilisp.py 存在
-    if not os.path.exists(minilisp_path):
-        print(f"Error: {minilisp_path} not found in the current directory.")
-        sys.exit(1)
+# 解析結果 (AST) 的快取目錄，原始碼未改變的測試檔不必重新解析
+AST_CACHE_DIR = os.path.join("__pycache__", "minilisp_ast")
 
-    lsp_files = sorted([f for f in os.listdir(test_dir) if f.endswith(".lsp")])
+def ast_cache_path(path):
+    """測試檔對應的解析結果快取檔：每個測試檔只有一個，過期時直接覆寫。"""
+    return os.path.join(AST_CACHE_DIR, os.path.basename(path) + '.pickle')
 
-    for lsp_file in lsp_files:
-        full_path = os.path.join(test_dir, lsp_file)
-        print(f"================================\nRunning {lsp_file}...")
+def ast_cache_key(src):
+    """
+    快取的有效條件：直譯器本身的修改時間與原始碼內容的雜湊。
+    直譯器更新後 (AST 結構可能改變) 或原始碼改變後，舊的快取就不會再被使用。
+    """
+    return os.stat(minilisp.__file__).st_mtime_ns, hashlib.sha256(src.encode()).hexdigest()
+
+def load_ast_cache(cache_file, key):
+    """
+    讀取快取的 AST 節點列表；快取不存在、已過期或檔案不完整時回傳 None。
+    其他錯誤 (例如節點無法重建) 不攔截，讓快取失效的問題能被發現。
+    """
+    try:
+        with open(cache_file, 'rb') as f:
+            if pickle.load(f) != key: return None # 先讀出 key，過期時不必載入整個 AST
+            return pickle.load(f)
+    except (OSError, EOFError, pickle.UnpicklingError): return None
+
+def save_ast_cache(cache_file, key, nodes):
+    """寫入 AST 快取。先寫入暫存檔再改名，避免多個行程同時寫入時讀到不完整的檔案；無法寫入檔案時直接略過。"""
+    tmp = f"{cache_file}.{os.getpid()}.tmp"
+    try:
+        os.makedirs(os.path.dirname(cache_file), exist_ok=True)
+        with open(tmp, 'wb') as f:
+            pickle.dump(key, f, pickle.HIGHEST_PROTOCOL)
+            pickle.dump(nodes, f, pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp, cache_file)
+    except OSError:
+        if os.path.exists(tmp): os.remove(tmp)
+
+def prune_ast_cache(paths):
+    """刪除不屬於 paths 中任何測試檔的快取檔 (測試檔已刪除，或舊版本留下的檔案)。"""
+    keep = {os.path.basename(ast_cache_path(p)) for p in paths}
+    try:
+        for f in os.listdir(AST_CACHE_DIR):
+            if f not in keep: os.remove(os.path.join(AST_CACHE_DIR, f))
+    except OSError:
+        pass
+
+def run_one(path):
+    """
+    在 worker 行程中執行單一測試檔，回傳 (標準輸出, 標準錯誤)。
+    minilisp 只在每個 worker 載入一次，不必為每個檔案重新啟動 Python。
+    原始碼未改變時直接載入快取的 AST，略過詞法分析與解析。
+    """
+    out, err = io.StringIO(), ""
+    with redirect_stdout(out):
+        try:
+            with open(path) as f:
+                src = f.read()
+            cache_file, key = ast_cache_path(path), ast_cache_key(src)
+            nodes = load_ast_cache(cache_file, key)
+            if nodes is None:
+                nodes = minilisp.parse_source(src) # 語法錯誤時以 sys.exit(0) 結束，不寫入快取
+                save_ast_cache(cache_file, key, nodes)
+            minilisp.run_nodes(nodes)
+        except SystemExit:
+            pass # 語法/執行期錯誤以 sys.exit(0) 結束，訊息已輸出
+        except Exception:
+            err = traceback.format_exc()
+    return out.getvalue(), err
 
+def run_source(src):
+    """執行一段 Mini-LISP 原始碼並回傳其輸出 (發生錯誤時到錯誤訊息為止；直譯器本身的例外也附在最後)。"""
+    out = io.StringIO()
+    with redirect_stdout(out):
         try:
-            # 執行 python minilisp.py <test_file>
-            result = subprocess.run(
-                [sys.executable, minilisp_path, full_path],
-                capture_output=True,
-                text=True,
-                check=False
-            )
-
-            # 顯示標準輸出
-            if result.stdout:
-                sys.stdout.write(result.stdout)
-            
-            # 顯示標準錯誤 (如果有)
-            if result.stderr:
-                sys.stderr.write(result.stderr)
+            minilisp.run_nodes(minilisp.parse_source(src))
+        except SystemExit:
+            pass
+        except Exception as e:
+            print(f"{type(e).__name__}: {e}")
+    return out.getvalue()
+
+# 運算元的求值順序：+、*、= 先求值所有運算元 (其中的輸出與錯誤都會發生)，再檢查類型或比較。
+# 每個函式呼叫兩次，JIT_THRESHOLD = 1 時第二次呼叫執行的是編譯後的版本。
+EVAL_ORDER = [
+    ("""
+(define f (fun (x) (print-num x) x))
+(define g (fun (a b) (= a 2 (f b))))
+(print-bool (g 2 2))
+(print-bool (g 1 7))
+""", "2\n#t\n7\n#f\n"),
+    ("""
+(define g (fun (a b) (= a 2 (/ 1 b))))
+(print-bool (g 2 1))
+(print-bool (g 1 0))
+""", "#f\nError: Division by zero\n"),
+    ("""
+(define f (fun (x) (print-num x) x))
+(define g (fun (a b) (+ a 1 (f b))))
+(print-num (g 1 2))
+(print-num (g #t 8))
+""", "2\n4\n8\nType Error: Expect 'number' but got 'boolean'.\n"),
+    ("""
+(define f (fun (x) (print-num x) x))
+(define g (fun (a b) (* a 1 (f b))))
+(print-num (g 1 2))
+(print-num (g #t 8))
+""", "2\n2\n8\nType Error: Expect 'number' but got 'boolean'.\n"),
+]
+
+def check_eval_order():
+    """以直譯與 JIT 編譯 (JIT_THRESHOLD = 1) 分別執行 EVAL_ORDER，回傳 (是否通過, 說明)。"""
+    saved = minilisp.JIT_THRESHOLD
+    try:
+        for threshold in (saved, 1):
+            minilisp.JIT_THRESHOLD = threshold
+            for src, want in EVAL_ORDER:
+                got = run_source(src)
+                if got != want:
+                    return False, f"JIT_THRESHOLD={threshold}: {src.strip().splitlines()[-1]} printed {got!r}, expected {want!r}"
+    finally:
+        minilisp.JIT_THRESHOLD = saved
+    return True, f"{len(EVAL_ORDER)} programs"
+
+# 在編譯後的函式本體中發生的錯誤，以及常數摺疊產生的大整數。
+# 每個函式先以正常參數呼叫一次，JIT_THRESHOLD = 1 時之後的呼叫執行的是編譯後的版本。
+JIT_PROGRAMS = [
+    """
+(define g (fun (a b) (+ a b)))
+(print-num (g 1 2))
+(print-num (g 1 #t))
+""",
+    """
+(define g (fun (a) (if a 1 2)))
+(print-num (g #t))
+(print-num (g 3))
+""",
+    """
+(define k (fun (x) x))
+(define g (fun (a) (if (= a 0) (k 1 2) (k a))))
+(print-num (g 1))
+(print-num (g 0))
+""",
+    """
+(define g (fun (f) (f 1)))
+(print-num (g (fun (x) x)))
+(print-num (g 3))
+""",
+    """
+(define g (fun (a b) (/ a b)))
+(print-num (g 4 2))
+(print-num (g 1 0))
+""",
+    """
+(define g (fun (a b) (mod a b)))
+(print-num (g 5 3))
+(print-num (g 1 0))
+""",
+    "(define big (* " + " ".join(["1000000000"] * 500) + """))
+(define g (fun (x) (> x big)))
+(define loop (fun (n) (if (= n 0) (g (* big 10)) (if (g n) #f (loop (- n 1))))))
+(print-bool (loop 100))
+""",
+]
+
+def check_jit():
+    """
+    以 JIT_THRESHOLD = 1 (第一次呼叫後即編譯) 執行所有測試檔與 JIT_PROGRAMS，
+    輸出應與直譯執行完全相同。回傳 (是否通過, 說明)。
+    """
+    sources = []
+    for f in sorted(os.listdir(TEST_DIR)):
+        if f.endswith(".lsp"):
+            with open(os.path.join(TEST_DIR, f)) as fp:
+                sources.append((f, fp.read()))
+    sources += [(f"JIT_PROGRAMS[{i}]", src) for i, src in enumerate(JIT_PROGRAMS)]
+    saved = minilisp.JIT_THRESHOLD
+    try:
+        for name, src in sources:
+            want = run_source(src)
+            minilisp.JIT_THRESHOLD = 1
+            got = run_source(src)
+            minilisp.JIT_THRESHOLD = saved
+            if got != want: return False, f"{name} printed {got!r}, expected {want!r}"
+    finally:
+        minilisp.JIT_THRESHOLD = saved
+    return True, f"{len(sources)} programs"
+
+# 參數皆為數字的長尾遞迴：尾呼叫在 apply 的迴圈中執行，記憶體用量不應隨迴圈次數成長
+TAIL_LOOP = """
+(define s (fun (n acc) (if (= n 0) acc (s (- n 1) (+ acc 1)))))
+(print-num (s 200000 0))
+"""
+TAIL_LOOP_PEAK = 1 << 20 # 允許的最大記憶體用量 (bytes)
 
+def check_tail_loop_memory():
+    """執行 TAIL_LOOP，回傳 (是否通過, 說明)。"""
+    nodes = minilisp.parse_source(TAIL_LOOP)
+    out = io.StringIO()
+    tracemalloc.start()
+    try:
+        with redirect_stdout(out): minilisp.run_nodes(nodes)
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    ok = out.getvalue() == "200000\n" and peak < TAIL_LOOP_PEAK
+    return ok, f"output {out.getvalue().strip()}, peak {peak} bytes"
+
+def check_ast_round_trip():
+    """每個測試檔的 AST 經 pickle 寫入再讀回後應與原本相同，否則快取無法使用。回傳 (是否通過, 說明)。"""
+    count = 0
+    for f in sorted(os.listdir(TEST_DIR)):
+        if not f.endswith(".lsp"): continue
+        with open(os.path.join(TEST_DIR, f)) as fp:
+            src = fp.read()
+        try:
+            with redirect_stdout(io.StringIO()): nodes = minilisp.parse_source(src)
+        except SystemExit:
+            continue # 語法錯誤的測試檔沒有 AST
+        data = pickle.dumps(nodes, pickle.HIGHEST_PROTOCOL)
+        try:
+            same = pickle.dumps(pickle.loads(data), pickle.HIGHEST_PROTOCOL) == data
         except Exception as e:
-            print(f"An unexpected error occurred: {e}")
+            return False, f"{f}: {type(e).__name__}: {e}"
+        if not same: return False, f"{f}: AST changed after round trip"
+        count += 1
+    return True, f"{count} files"
+
+def run_tests():
+    print("Starting Mini-LISP Python Test Suite...\n")
+
+    lsp_files = sorted([f for f in os.listdir(TEST_DIR) if f.endswith(".lsp")])
+    paths = [os.path.join(TEST_DIR, f) for f in lsp_files]
+    prune_ast_cache(paths)
+
+    # 平行執行所有測試檔 (每個 worker 行程各自隔離 sys.exit)，再依檔名順序輸出
+    with Pool() as pool:
+        results = pool.map(run_one, paths)
+
+    for lsp_file, (stdout, stderr) in zip(lsp_files, results):
+        print(f"================================\nRunning {lsp_file}...")
+
+        # 顯示標準輸出
+        if stdout:
+            sys.stdout.write(stdout)
         
+        # 顯示標準錯誤 (如果有)
+        if stderr:
+            sys.stderr.write(stderr)
+        
+        print("--------------------------------")
+
+    # 直譯器本身的檢查
+    checks = [
+        ("operand evaluation order", check_eval_order),
+        ("JIT output", check_jit),
+        ("AST cache round trip", check_ast_round_trip),
+        ("tail loop memory", check_tail_loop_memory),
+    ]
+    for name, check in checks:
+        ok, detail = check()
+        print(f"================================\nChecking {name}...")
+        print(f"{'OK' if ok else 'FAILED'}: {detail}")
         print("--------------------------------")
 
     print("\nAll tests completed.")